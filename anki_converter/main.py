@@ -3,9 +3,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import genanki
+import hashlib
+import io
 import os
-from fastapi.responses import StreamingResponse
-from contextlib import asynccontextmanager
+import re
+import asyncio
+import itertools
+import sqlite3
+import tempfile
+import time
+import zipfile
+from urllib.parse import quote
+from fastapi.responses import Response
 
 app = FastAPI(title="Anki Deck Generator")
 
@@ -18,6 +27,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Model ID derived from a stable digest so it is the same across workers and restarts,
+# which lets Anki recognise cards from different decks as the same note type
+BASIC_MODEL_ID = int(hashlib.sha256(b"ankibot.basic.v1").hexdigest()[:15], 16)
+
+# The card model never changes, so it is built once at import time
+BASIC_MODEL = genanki.Model(
+    BASIC_MODEL_ID,
+    'Basic Model',
+    fields=[
+        {'name': 'Question'},
+        {'name': 'Answer'},
+    ],
+    templates=[
+        {
+            'name': 'Card 1',
+            'qfmt': '{{Question}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
+        },
+    ])
+
 # Define request models
 class QAItem(BaseModel):
     question: str
@@ -28,13 +57,41 @@ class AnkiDeckRequest(BaseModel):
     qa_list: List[QAItem]
     deck_id: Optional[int] = None  # Allow custom deck ID for consistency
 
+def write_package(deck: genanki.Deck, file):
+    """
+    Write the deck as an .apkg package to a path or file object.
+    Same output as genanki.Package.write_to_file, but the scratch collection database
+    is filled in a single transaction without journaling or fsync and is removed afterwards
+    """
+    package = genanki.Package(deck)
+    fd, db_path = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            # The database only lives until it is zipped, durability is not needed
+            conn.execute("PRAGMA journal_mode=MEMORY")
+            conn.execute("PRAGMA synchronous=OFF")
+            timestamp = time.time()
+            package.write_to_db(conn.cursor(), timestamp, itertools.count(int(timestamp * 1000)))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        with zipfile.ZipFile(file, 'w') as outzip:
+            outzip.write(db_path, 'collection.anki2')
+            outzip.writestr('media', '{}')  # Decks from this service have no media files
+    finally:
+        os.unlink(db_path)
+
 def create_anki_deck(title: str, qa_list: List[QAItem], deck_id: Optional[int] = None):
     """
     Create an Anki deck with the given title and Q&A pairs
     """
-    # Generate a random deck ID if not provided
+    # Derive the deck ID from the title if not provided. hash() is randomised per process,
+    # a digest gives the same ID on every worker and across restarts
     if deck_id is None:
-        deck_id = abs(hash(title)) % (10 ** 10)  # Generate a 10-digit ID
+        deck_id = int(hashlib.sha256(title.encode("utf-8")).hexdigest(), 16) % (10 ** 10)  # 10-digit ID
     
     # Create a new deck
     deck = genanki.Deck(
@@ -42,89 +99,48 @@ def create_anki_deck(title: str, qa_list: List[QAItem], deck_id: Optional[int] =
         name=title,
     )
     
-    # Create a model for our cards
-    model = genanki.Model(
-        abs(hash("Basic (and reversed card)")),  # Generate a unique ID for the model
-        'Basic Model',
-        fields=[
-            {'name': 'Question'},
-            {'name': 'Answer'},
-        ],
-        templates=[
-            {
-                'name': 'Card 1',
-                'qfmt': '{{Question}}',
-                'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
-            },
-        ])
-    
     # Add cards to the deck
-    for qa in qa_list:
-        note = genanki.Note(
-            model=model,
-            fields=[qa.question, qa.answer]
-        )
-        deck.add_note(note)
+    deck.notes.extend(
+        genanki.Note(model=BASIC_MODEL, fields=[qa.question, qa.answer])
+        for qa in qa_list
+    )
     
-    # Generate a temporary file path
-    filename = f"{title.replace(' ', '_')}.apkg"
-    filepath = f"/tmp/{filename}"
+    # Only keep characters that are safe in a file name and a header value
+    filename = f"{re.sub(r'[^A-Za-z0-9_-]', '_', title)[:64] or 'deck'}.apkg"
     
-    # Save the deck to a file
-    genanki.Package(deck).write_to_file(filepath)
+    # Write the package to memory, there is no need for a file on disk
+    buffer = io.BytesIO()
+    write_package(deck, buffer)
     
-    return filepath, filename
-
-@asynccontextmanager
-async def temp_file_generator(filepath: str):
-    """Context manager to handle temporary file cleanup"""
-    try:
-        with open(filepath, 'rb') as f:
-            yield f
-    finally:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-
-def read_in_chunks(file_object, chunk_size=8192):
-    """Generator to read file in chunks"""
-    while True:
-        data = file_object.read(chunk_size)
-        if not data:
-            break
-        yield data
+    return buffer, filename
 
 @app.post("/generate-deck")
 async def generate_deck(request: AnkiDeckRequest):
     """
     Generate an Anki deck from a list of Q&A pairs
     """
-    filepath = None
     try:
-        filepath, filename = create_anki_deck(
+        # Building the package is blocking sqlite/zip work, keep it off the event loop
+        buffer, filename = await asyncio.to_thread(
+            create_anki_deck,
             title=request.title,
             qa_list=request.qa_list,
             deck_id=request.deck_id
         )
         
-        # Create a generator to stream the file in chunks
-        async def file_stream():
-            async with temp_file_generator(filepath) as file:
-                while chunk := file.read(8192):
-                    yield chunk
-        
-        # Return the file as a streaming response
-        return StreamingResponse(
-            file_stream(),
-            media_type='application/octet-stream',
+        return Response(
+            content=buffer.getvalue(),
+            media_type="application/apkg",
             headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Content-Type": "application/apkg"
+                # filename is the ASCII fallback, filename* (RFC 5987) keeps umlauts etc. of the title
+                "Content-Disposition": (
+                    f"attachment; filename={filename}; "
+                    f"filename*=UTF-8''{quote(request.title + '.apkg', safe='') if request.title else filename}"
+                )
             }
         )
         
     except Exception as e:
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
@@ -134,4 +150,12 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # The app must be passed as an import string for uvicorn to start several workers
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count()
+    )
@@ -1,13 +1,57 @@
 from mcp.server.fastmcp import FastMCP
 import os
-import json
+import orjson
 import genanki
 import random
 import hashlib
-import html
+import asyncio
+import re
 
 mcp = FastMCP("StudyTools")
 
+# Same escaping as html.escape, done in a single pass over the string
+HTML_ESCAPE_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;",
+})
+
+def to_json(data) -> str:
+    """Serialize a tool result to a JSON string."""
+    return orjson.dumps(data).decode()
+
+def stable_id(key: bytes) -> int:
+    """Derive a stable 60-bit integer id (as used by Anki) from a key."""
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 60) - 1)
+
+def safe_filename_part(value: str) -> str:
+    """Clamp a user supplied value to characters that are safe in a file name."""
+    return re.sub(r'[^A-Za-z0-9_-]', '_', value)[:64]
+
+def qa_journal_path(file_path: str) -> str:
+    """Path of the JSON-lines journal holding the QA pairs of a QA file."""
+    return os.path.splitext(file_path)[0] + ".qa.jsonl"
+
+# One note type shared by all QA decks, built once at import time. Its id is stable
+# across restarts, so Anki recognises cards from different decks as the same note type
+QA_MODEL = genanki.Model(
+    stable_id(b"ankibot.qa.v1"),
+    'Simple QA Model',
+    fields=[
+        {'name': 'Question'},
+        {'name': 'Answer'},
+    ],
+    templates=[
+        {
+            'name': 'Card 1',
+            'qfmt': '{{Question}}',  # Question format
+            'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',  # Answer format
+        },
+    ])
+
 @mcp.tool()
 async def get_hole_file_content(file_path: str) -> str:
     """Get all the file content as one string."""
@@ -20,13 +64,17 @@ async def get_hole_file_content(file_path: str) -> str:
 async def create_qa_file(title: str, icon: str, job_id: str) -> str:
     """Create a QA file."""
     print("create_qa_file with title: " + title + " and icon: " + icon + " and job_id: " + job_id)
-    output_filename = "output_qa_file_" + title + "_" + job_id + ".json"
+    output_filename = f"output_qa_file_{safe_filename_part(title)}_{safe_filename_part(job_id)}.json"
+    
+    with open(output_filename, "wb") as f:
+        f.write(orjson.dumps({"title": title, "icon": icon, "job_id": job_id, "qa_pairs": []}))
     
-    with open(output_filename, "w") as f:
-        f.write(json.dumps({"title": title, "icon": icon, "job_id": job_id, "qa_pairs": []}))
+    # QA pairs are appended to a separate journal, one JSON object per line,
+    # and merged into qa_pairs by finish_qa_file
+    open(qa_journal_path(output_filename), "wb").close()
     
     full_path = os.path.abspath(output_filename)
-    return json.dumps({"message": "QA file {output_filename} created. Job id: {job_id}", "file_path": full_path})
+    return to_json({"message": "QA file {output_filename} created. Job id: {job_id}", "file_path": full_path})
 
 @mcp.tool()
 async def write_to_qa_file(file_path: str, content: list) -> str:
@@ -42,41 +90,10 @@ async def write_to_qa_file(file_path: str, content: list) -> str:
     ...]
     """
     print("write_to_qa_file with file_path: " + file_path + " and content: " + str(content))
-    # Initialize with a default structure
-    data_to_write = {"qa_pairs": []}
-
-    try:
-        with open(file_path, "r") as f:
-            file_content = f.read()
-            if file_content.strip():  # Ensure content is not just whitespace
-                loaded_data = json.loads(file_content)
-                # Ensure the loaded data has 'qa_pairs' and it's a list
-                if isinstance(loaded_data, dict) and isinstance(loaded_data.get("qa_pairs"), list):
-                    data_to_write = loaded_data
-                else:
-                    # Loaded data is not in the expected format, or 'qa_pairs' is missing/wrong type.
-                    print(f"Warning: File {file_path} did not contain the expected JSON structure (dict with 'qa_pairs' list). Starting with a new structure.")
-            # If file_content is empty or whitespace, data_to_write remains {"qa_pairs": []}
-            
-    except FileNotFoundError:
-        # File doesn't exist, will be created with data_to_write (which is {"qa_pairs": []} initially)
-        print(f"Info: File {file_path} not found. A new file will be created.")
-    except json.JSONDecodeError:
-        # File exists but contains invalid JSON.
-        # data_to_write remains {"qa_pairs": []}, and the file will be overwritten.
-        print(f"Warning: File {file_path} contained invalid JSON. It will be overwritten with new content.")
-    
-    # Ensure 'qa_pairs' key exists and is a list, even if it was somehow lost
-    if "qa_pairs" not in data_to_write or not isinstance(data_to_write.get("qa_pairs"), list):
-        data_to_write["qa_pairs"] = []
-
-    # Append new content
-    data_to_write["qa_pairs"].extend(content)
-    
-    # Write back to the file
+    # Append the new pairs to the journal instead of rewriting the whole file
     try:
-        with open(file_path, "w") as fw:
-            json.dump(data_to_write, fw, indent=4) # Use json.dump for writing to file object and add indent
+        with open(qa_journal_path(file_path), "ab") as f:
+            f.write(b"".join(orjson.dumps(item) + b"\n" for item in content))
     except IOError as e:
         print(f"Error writing to file {file_path}: {e}")
         return f"Error writing to file: {e}" # Return an error message
@@ -91,26 +108,40 @@ async def finish_qa_file(file_path: str) -> str:
     print(f"finish_qa_file with file_path: {file_path}")
 
     try:
-        # Ensure UTF-8 encoding for broader compatibility
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        # orjson decodes the raw UTF-8 bytes directly
+        with open(file_path, "rb") as f:
+            data = orjson.loads(f.read())
+        
+        # Pairs merged by an earlier finish_qa_file call are kept inline
+        qa_pairs = data.setdefault("qa_pairs", [])
+        try:
+            with open(qa_journal_path(file_path), "rb") as f:
+                for line in f:
+                    if line.strip():
+                        qa_pairs.append(orjson.loads(line))
+        except FileNotFoundError:
+            pass
+        
+        # Readers of the QA file expect all pairs in it, so merge the journal back in
+        with open(file_path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        open(qa_journal_path(file_path), "wb").close()
     except FileNotFoundError:
-        return json.dumps({"error": "Input JSON file not found.", "file_path": file_path, "status": "error"})
-    except json.JSONDecodeError:
-        return json.dumps({"error": "Invalid JSON format in input file.", "file_path": file_path, "status": "error"})
+        return to_json({"error": "Input JSON file not found.", "file_path": file_path, "status": "error"})
+    except orjson.JSONDecodeError:
+        return to_json({"error": "Invalid JSON format in input file.", "file_path": file_path, "status": "error"})
     except Exception as e:
-        return json.dumps({"error": f"Error reading input file: {str(e)}", "file_path": file_path, "status": "error"})
+        return to_json({"error": f"Error reading input file: {str(e)}", "file_path": file_path, "status": "error"})
 
     title = data.get("title", "Untitled Deck")
     icon = data.get("icon", "")  # Default to empty string if not present
     job_id = data.get("job_id")
-    qa_pairs = data.get("qa_pairs", [])
 
     if not job_id:
-        return json.dumps({"error": "job_id is missing in the JSON file.", "file_path": file_path, "status": "error"})
+        return to_json({"error": "job_id is missing in the JSON file.", "file_path": file_path, "status": "error"})
     
     if not qa_pairs:
-        return json.dumps({
+        return to_json({
             "message": "No QA pairs found. Anki deck generation skipped.",
             "job_id": job_id,
             "file_path": file_path, # Original JSON path
@@ -118,32 +149,12 @@ async def finish_qa_file(file_path: str) -> str:
         })
 
     # Generate a unique integer ID for the deck from the job_id string
-    deck_id_hash = hashlib.sha256(job_id.encode('utf-8')).hexdigest()
-    deck_id = int(deck_id_hash[:15], 16)  # Use first 15 hex chars
+    deck_id = stable_id(job_id.encode('utf-8'))
 
     deck_title = f"{icon} {title}".strip()
     if not deck_title: # Ensure deck title is not empty if icon and title were empty
         deck_title = job_id 
 
-    # Define Anki Model
-    model_id_hash = hashlib.sha256(f"{job_id}_model".encode('utf-8')).hexdigest()
-    model_id = int(model_id_hash[:15], 16)
-    
-    my_model = genanki.Model(
-        model_id,
-        f'Simple Model for {title if title else job_id}', # Model name
-        fields=[
-            {'name': 'Question'},
-            {'name': 'Answer'},
-        ],
-        templates=[
-            {
-                'name': 'Card 1',
-                'qfmt': '{{Question}}',  # Question format
-                'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',  # Answer format
-            },
-        ])
-
     anki_deck = genanki.Deck(deck_id, deck_title)
 
     notes_added_count = 0
@@ -152,12 +163,12 @@ async def finish_qa_file(file_path: str) -> str:
         answer = pair.get('answer')
 
         if question and answer:
-            question_escaped = html.escape(question)
-            answer_escaped = html.escape(answer)
+            question_escaped = question.translate(HTML_ESCAPE_TABLE)
+            answer_escaped = answer.translate(HTML_ESCAPE_TABLE)
 
             note_guid = genanki.guid_for(job_id, str(i)) # Stable GUID
             note = genanki.Note(
-                model=my_model,
+                model=QA_MODEL,
                 fields=[question_escaped, answer_escaped],
                 guid=note_guid
             )
@@ -167,7 +178,7 @@ async def finish_qa_file(file_path: str) -> str:
             print(f"Skipping QA pair at index {i} for job_id {job_id} due to missing 'q' or 'a': {pair}")
     
     if notes_added_count == 0:
-        return json.dumps({
+        return to_json({
             "message": "No valid QA pairs found to create notes. Anki deck generation skipped.",
             "job_id": job_id,
             "file_path": file_path,
@@ -182,12 +193,12 @@ async def finish_qa_file(file_path: str) -> str:
     output_decks_dir = os.path.join(input_dir, "anki_decks_output")
     os.makedirs(output_decks_dir, exist_ok=True)
     
-    apkg_filename = f"{job_id}.apkg"
+    apkg_filename = f"{safe_filename_part(job_id)}.apkg"
     apkg_file_path = os.path.join(output_decks_dir, apkg_filename)
 
     try:
-        anki_package.write_to_file(apkg_file_path)
-        return json.dumps({
+        await asyncio.to_thread(anki_package.write_to_file, apkg_file_path)
+        return to_json({
             "message": f"Anki deck '{deck_title}' created successfully.",
             "apkg_file_path": apkg_file_path,
             "job_id": job_id,
@@ -196,7 +207,7 @@ async def finish_qa_file(file_path: str) -> str:
         })
     except Exception as e:
         print(f"Error writing Anki package for job_id {job_id}: {e}")
-        return json.dumps({
+        return to_json({
             "error": f"Failed to write Anki package: {str(e)}",
             "job_id": job_id,
             "status": "error"
@@ -1,28 +1,39 @@
 import os
+import logging
+import math
+import re
+import orjson
+import hashlib
 import uuid
 import asyncio
-import base64
-import io
-import nest_asyncio
-from datetime import datetime
-from typing import Optional, Dict, List, Tuple
+import random
+import time
+import numpy as np
+import simplejpeg
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional, Dict, List, Tuple, Deque
 
+import aiofiles
+import aiofiles.os
+import aiofiles.tempfile
+import diskcache
+from redis.asyncio import Redis
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, status
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic_settings import BaseSettings
-from pdf2image import convert_from_bytes
-from PIL import Image
+import pypdfium2 as pdfium
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, SystemMessage
+from google.api_core import exceptions as google_exceptions
+import google.generativeai as genai
 
 # Load environment variables
 load_dotenv()
 
-# Apply nest_asyncio to allow nested event loops
-nest_asyncio.apply()
-
 class Settings(BaseSettings):
     google_api_key: str = ""
     openai_api_key: str = ""
@@ -30,6 +41,15 @@ class Settings(BaseSettings):
     langsmith_tracing: bool = False
     langsmith_endpoint: str = ""
     langsmith_project: str = ""
+    gemini_concurrency: int = 10  # Max. number of Gemini requests in flight
+    gemini_rpm: int = 60  # Requests per minute allowed by the provider
+    gemini_tpm: int = 100_000  # Tokens per minute allowed by the provider
+    redis_url: str = "redis://localhost:6379/0"
+    job_ttl_seconds: int = 24 * 60 * 60  # Jobs are removed from Redis after a day
+    cache_dir: str = "/tmp/pdf2md_cache"
+    cache_size_limit: int = 5 << 30  # 5 GiB
+    max_image_dim: int = 2048  # Longest side in pixels of the page images sent to Gemini
+    log_level: str = "INFO"  # Set to DEBUG to log every request and processing step
     
     class Config:
         env_file = ".env"
@@ -37,72 +57,290 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-MAX_WORKERS = 100
+logging.basicConfig(level=settings.log_level.upper())
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = settings.gemini_concurrency
+
+# Limits the number of concurrent Gemini requests to stay within the provider's rate limits.
+# This and the rate limiter below are per process, see the README on running several workers
+llm_semaphore = asyncio.Semaphore(MAX_WORKERS)
+
+# Tokens reserved for the answer when estimating the size of a request
+OUTPUT_TOKEN_BUDGET = 1000
+
+class TokenBucket:
+    """Sliding window limit on the requests and tokens sent per minute."""
+    
+    def __init__(self, rpm: int, tpm: int, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self.entries: Deque[Tuple[float, int]] = deque()  # (timestamp, tokens) of recent requests
+        self.tokens = 0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: int) -> None:
+        """Wait until a request of the given size fits into the window and record it."""
+        # A request larger than the whole budget still has to go through once the window is empty
+        tokens = min(tokens, self.tpm)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.entries and self.entries[0][0] <= now - self.window:
+                    self.tokens -= self.entries.popleft()[1]
+                
+                if len(self.entries) < self.rpm and self.tokens + tokens <= self.tpm:
+                    self.entries.append((now, tokens))
+                    self.tokens += tokens
+                    return
+                
+                # Wait for the oldest request to leave the window
+                await asyncio.sleep(self.entries[0][0] + self.window - now)
+
+rate_limiter = TokenBucket(rpm=settings.gemini_rpm, tpm=settings.gemini_tpm)
+
+# Gemini bills images per 768x768 tile, the size of the JPEG doesn't matter
+IMAGE_TILE_SIZE = 768
+IMAGE_TILE_TOKENS = 258
+
+def estimate_tokens(images: List[bytes]) -> int:
+    """Rough token estimate of a request with the given page images.
+    Pages are at most MAX_DIM pixels on each side, so each one costs at most this many tiles."""
+    tiles_per_image = math.ceil(MAX_DIM / IMAGE_TILE_SIZE) ** 2
+    return len(images) * tiles_per_image * IMAGE_TILE_TOKENS + OUTPUT_TOKEN_BUDGET
+
+# Errors worth retrying with exponential backoff
+RETRY_ATTEMPTS = 5
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,  # 429
+    google_exceptions.InternalServerError,  # 500
+    google_exceptions.ServiceUnavailable,  # 503
+)
+
+# Quality of the JPEG page images sent to Gemini
+JPEG_QUALITY = 85
+
+# Gemini works on tiles of 768px, pixels beyond MAX_DIM only cost tokens and upload time
+MAX_DIM = settings.max_image_dim
+MAX_DPI = 300
+
+# Number of pages sent to Gemini in a single request
+BATCH_SIZE = 6
+
+# Markers the model is asked to put around each page of a batch
+PAGE_START = "<<<PAGE {k}>>>"
+PAGE_END = "<<<END>>>"
+PAGE_PATTERN = re.compile(r"<<<PAGE (\d+)>>>\s*(.*?)\s*<<<END>>>", re.DOTALL)
+
+# Rendering is CPU bound and pdfium is not thread-safe, so pages are rendered in worker
+# processes, which also keeps the event loop free for other requests
+RENDER_WORKERS = os.cpu_count() or 1
+render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+
+# Max. number of page batches waiting between two stages of the processing pipeline
+PIPELINE_QUEUE_SIZE = 4
+
+def pdf_page_count(pdf_path: str) -> int:
+    """Number of pages of a PDF. Runs in the render pool, pdfium must not be used from several threads."""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def render_page_range(pdf_path: str, first_page: int, last_page: int) -> List[bytes]:
+    """Render the pages first_page..last_page (1-based, inclusive) to JPEG bytes. Runs in the render pool.
+    The workers open the PDF by path, so the file is never copied between processes."""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        pages = []
+        for index in range(first_page - 1, last_page):
+            page = pdf[index]
+            # Render the longest side at MAX_DIM pixels, small pages at no more than MAX_DPI
+            scale = min(MAX_DPI / 72, MAX_DIM / max(page.get_size()))
+            bitmap = page.render(scale=scale, rev_byteorder=True)  # RGB byte order for simplejpeg
+            pixels = np.ascontiguousarray(bitmap.to_numpy())
+            pages.append(simplejpeg.encode_jpeg(pixels, quality=JPEG_QUALITY, colorspace="RGB"))
+        return pages
+    finally:
+        pdf.close()
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Extracted page texts keyed by the page image, a page that was already seen is not sent again
+response_cache = diskcache.Cache(settings.cache_dir, size_limit=settings.cache_size_limit)
+
+# diskcache does blocking sqlite I/O, these helpers are run in the default thread pool
+def cache_get_many(keys: List[str]) -> List[Optional[str]]:
+    """Look up several page texts in the response cache, None for pages that are not cached."""
+    return [response_cache.get(key) for key in keys]
+
+def cache_set_many(items: Dict[str, str]) -> None:
+    """Store several page texts in the response cache."""
+    for key, text in items.items():
+        response_cache.set(key, text)
+
+genai.configure(api_key=settings.google_api_key)
+
+# The prompts don't change between requests, they are built once here
+SYSTEM_PROMPT = """You are a helpful assistant that extracts text and tables from images. 
+            Return the content in clean markdown format. For tables, use markdown table syntax. 
+            Preserve the original structure as much as possible but dont include any additional formatting like a lot of whitespace or dots or underscores. only answer with the content."""
+BATCH_SYSTEM_PROMPT = """You are a helpful assistant that extracts text and tables from images. 
+            Return the content in clean markdown format. For tables, use markdown table syntax. 
+            Preserve the original structure as much as possible but dont include any additional formatting like a lot of whitespace or dots or underscores. only answer with the content.
+            You will get several images, each one is a page of the same document."""
+PAGE_INSTRUCTION = "Extract all text and tables from this image."
+BATCH_INSTRUCTION = (
+    "Extract all text and tables from each of the {count} images, in order. "
+    "For the k-th image (starting at 1) emit exactly:\n"
+    + PAGE_START.format(k="k") + "\n<markdown>\n" + PAGE_END
+)
+GENERATION_CONFIG = {"temperature": 0}
 
 class GoogleGenerativeAI:
     def __init__(self):
-        self.chat = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            temperature=0,
-            api_key=settings.google_api_key,
-            
+        self.model = genai.GenerativeModel(
+            GEMINI_MODEL, system_instruction=SYSTEM_PROMPT, generation_config=GENERATION_CONFIG
         )
+        self.batch_model = genai.GenerativeModel(
+            GEMINI_MODEL, system_instruction=BATCH_SYSTEM_PROMPT, generation_config=GENERATION_CONFIG
+        )
+    
+    async def _generate(self, model: genai.GenerativeModel, contents: list, estimated_tokens: int) -> str:
+        """Run a Gemini request through the concurrency and rate limits, retrying rate limit and server errors."""
+        async with llm_semaphore:
+            for attempt in range(RETRY_ATTEMPTS):
+                await rate_limiter.acquire(estimated_tokens)
+                try:
+                    response = await model.generate_content_async(contents)
+                    return response.text
+                except RETRYABLE_ERRORS as e:
+                    if attempt == RETRY_ATTEMPTS - 1:
+                        raise
+                    delay = min(2 ** attempt, 30) + random.random()
+                    logger.warning("Gemini request failed (%s), retrying in %.1fs", e, delay)
+                    await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _cache_key(image: bytes) -> str:
+        """Key of a page image in the response cache."""
+        return f"{GEMINI_MODEL}:{hashlib.sha256(image).hexdigest()}"
+    
+    async def extract_text_from_image(self, image: bytes) -> str:
+        cache_key = self._cache_key(image)
+        cached_text = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached_text is not None:
+            return cached_text
         
-    async def extract_text_from_image(self, image_base64: str) -> str:
         try:
-            # Create the prompt
-            system_prompt = """You are a helpful assistant that extracts text and tables from images. 
-            Return the content in clean markdown format. For tables, use markdown table syntax. 
-            Preserve the original structure as much as possible but dont include any additional formatting like a lot of whitespace or dots or underscores. only answer with the content."""
-            
-            # Create the message with the image
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(
-                    content=[
-                        {"type": "text", "text": "Extract all text and tables from this image."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}",
-                                "detail": "high"
-                            },
-                        },
-                    ]
-                )
-            ]
+            # The JPEG bytes are sent as they are, without base64 encoding them first
+            contents = [PAGE_INSTRUCTION, {"mime_type": "image/jpeg", "data": image}]
             
             # Get the response
-            response = await self.chat.agenerate([messages])
-            extracted_text = response.generations[0][0].text
+            extracted_text = await self._generate(self.model, contents, estimate_tokens([image]))
+            
+            cleaned_text = self._clean_text(extracted_text)
+            await asyncio.to_thread(response_cache.set, cache_key, cleaned_text)
+            return cleaned_text
+            
+        except Exception as e:
+            logger.error("Error in Google Generative AI: %s", e)
+            raise
+    
+    async def extract_text_from_images(self, images: List[bytes]) -> List[str]:
+        """Extract the text of several page images, one result per image.
+        Images that are not cached yet are sent with a single request."""
+        cache_keys = [self._cache_key(image) for image in images]
+        results = await asyncio.to_thread(cache_get_many, cache_keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+        
+        if len(missing) == 1:
+            results[missing[0]] = await self.extract_text_from_image(images[missing[0]])
+        elif missing:
+            extracted_texts = await self._extract_batch([images[i] for i in missing])
+            for i, extracted_text in zip(missing, extracted_texts):
+                results[i] = extracted_text
+            await asyncio.to_thread(cache_set_many, {cache_keys[i]: results[i] for i in missing})
+        return results
+    
+    async def _extract_batch(self, images: List[bytes]) -> List[str]:
+        """Extract the text of several page images with a single request, one result per image."""
+        try:
+            contents = [BATCH_INSTRUCTION.format(count=len(images))]
+            contents.extend({"mime_type": "image/jpeg", "data": image} for image in images)
             
-            # Clean up the extracted text
-            if extracted_text:
-                # Replace multiple dots (3 or more) with just three dots
-                import re
-                cleaned_text = re.sub(r'\.{3,}', '...', extracted_text)
-                # remove all underscores that are not between two words
-                cleaned_text = re.sub(r'(?<!\w)_(?!\w)', '', cleaned_text)
-                # remove all ----
-                cleaned_text = re.sub(r'----', '', cleaned_text)
-                # Remove excessive whitespace (more than 2 newlines or spaces)
-                cleaned_text = re.sub(r'\n{3,}', '\n\n', cleaned_text)
-                cleaned_text = re.sub(r' {2,}', ' ', cleaned_text)
-                return cleaned_text.strip()
-            return extracted_text
+            extracted_text = await self._generate(self.batch_model, contents, estimate_tokens(images))
+            
+            # Split the answer into pages using the markers we asked for
+            pages = {int(num): text for num, text in PAGE_PATTERN.findall(extracted_text or "")}
+            if sorted(pages) != list(range(1, len(images) + 1)):
+                raise ValueError(
+                    f"Expected {len(images)} pages in batch response, got {sorted(pages)}"
+                )
+            return [self._clean_text(pages[k]) for k in sorted(pages)]
             
         except Exception as e:
-            print(f"Error in LangChain Google Generative AI: {str(e)}")
+            logger.error("Error in Google Generative AI batch: %s", e)
             raise
+    
+    @staticmethod
+    def _clean_text(extracted_text: str) -> str:
+        """Clean up the extracted markdown text."""
+        if extracted_text:
+            # Replace multiple dots (3 or more) with just three dots
+            cleaned_text = re.sub(r'\.{3,}', '...', extracted_text)
+            # remove all underscores that are not between two words
+            cleaned_text = re.sub(r'(?<!\w)_(?!\w)', '', cleaned_text)
+            # remove all ----
+            cleaned_text = re.sub(r'----', '', cleaned_text)
+            # Remove excessive whitespace (more than 2 newlines or spaces)
+            cleaned_text = re.sub(r'\n{3,}', '\n\n', cleaned_text)
+            cleaned_text = re.sub(r' {2,}', ' ', cleaned_text)
+            return cleaned_text.strip()
+        return extracted_text
 
-google_client = GoogleGenerativeAI()
+@lru_cache(maxsize=1)
+def get_google_client() -> GoogleGenerativeAI:
+    """The shared Gemini client. All pages go through this one instance, so its underlying
+    connection is reused instead of paying the connection setup per page."""
+    return GoogleGenerativeAI()
 
 from models import JobStatus, JobResponse, UploadResponse
 
-app = FastAPI(title="PDF to Markdown API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    render_pool.shutdown(cancel_futures=True)
 
-# In-memory storage for jobs
-jobs: Dict[str, Dict] = {}
+app = FastAPI(title="PDF to Markdown API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Size of the chunks an upload is copied to disk with
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Jobs are stored in Redis so they are shared between workers and don't stay in process memory
+redis_client = Redis.from_url(settings.redis_url)
+
+# Status polls and job updates need the current time often, it's only formatted once per second
+now_iso_cache: Tuple[int, str] = (0, "")
+
+def now_iso() -> str:
+    """Current UTC time as an ISO 8601 string with second resolution."""
+    global now_iso_cache
+    second = time.time_ns() // 1_000_000_000
+    if now_iso_cache[0] != second:
+        now_iso_cache = (second, datetime.fromtimestamp(second, tz=timezone.utc).isoformat())
+    return now_iso_cache[1]
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    """Load a job from Redis, None if it doesn't exist (anymore)."""
+    data = await redis_client.get(f"job:{job_id}")
+    return orjson.loads(data) if data else None
+
+async def save_job(job: Dict) -> None:
+    """Store a job in Redis."""
+    await redis_client.set(f"job:{job['id']}", orjson.dumps(job), ex=settings.job_ttl_seconds)
 
 # Enable CORS
 app.add_middleware(
@@ -114,132 +352,135 @@ app.add_middleware(
 )
 
 class PDFProcessor:
-    @staticmethod
-    def pdf_to_images(pdf_bytes: bytes, dpi: int = 300) -> List[Image.Image]:
-        """Convert PDF to a list of PIL Images."""
-        try:
-            return convert_from_bytes(pdf_bytes, dpi=dpi)
-        except Exception as e:
-            raise Exception(f"Error converting PDF to images: {str(e)}")
-    
-    @staticmethod
-    def image_to_base64(image: Image.Image) -> str:
-        """Convert PIL Image to base64 string."""
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    @staticmethod
-    async def process_page_with_ocr(page_num: int, image: Image.Image) -> Tuple[int, str]:
-        """Process a single page with gpt-4.1-mini"""
-        try:
-            image_base64 = PDFProcessor.image_to_base64(image)
-            
-            extracted_text = await google_client.extract_text_from_image(image_base64)
-            
-            return f"{page_prefix}{extracted_text.strip()}{page_suffix}"
-        except Exception as e:
-            print(f"Error processing page {page_num}: {str(e)}")
-            return f"[Error processing page {page_num + 1}]"
-    
     @staticmethod
     async def _process_page(
-        image,
+        image: bytes,
         page_num: int,
         page_prefix: str,
         page_suffix: str
     ) -> str:
         """Process a single page image and return its markdown content."""
         try:
-            # Convert image to base64
-            import base64
-            from io import BytesIO
-            
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            
             # Use Google Generative AI to extract text from image
-            google_client = GoogleGenerativeAI()
-            extracted_text = await google_client.extract_text_from_image(img_str)
+            extracted_text = await get_google_client().extract_text_from_image(image)
             
             return f"{page_prefix}{extracted_text.strip()}{page_suffix}"
             
         except Exception as e:
-            print(f"Error processing page {page_num}: {str(e)}")
+            logger.error("Error processing page %d: %s", page_num, e)
             return f"{page_prefix}[Error processing page {page_num + 1}]{page_suffix}"
     
+    @staticmethod
+    async def _process_batch(
+        images: List[bytes],
+        first_page_num: int,
+        page_prefix: str,
+        page_suffix: str
+    ) -> List[str]:
+        """Process several page images with one request and return their markdown contents."""
+        try:
+            extracted_texts = await get_google_client().extract_text_from_images(images)
+            return [f"{page_prefix}{text.strip()}{page_suffix}" for text in extracted_texts]
+        except ValueError as e:
+            # Fall back to one request per page when the model mixed up the page markers
+            logger.warning(
+                "Error processing pages %d-%d as batch: %s",
+                first_page_num, first_page_num + len(images) - 1, e
+            )
+            return await asyncio.gather(*[
+                PDFProcessor._process_page(image, first_page_num + i, page_prefix, page_suffix)
+                for i, image in enumerate(images)
+            ])
+        except Exception as e:
+            # Retries are already used up (e.g. rate limited), one request per page would only add load
+            logger.error(
+                "Error processing pages %d-%d: %s",
+                first_page_num, first_page_num + len(images) - 1, e
+            )
+            return [
+                f"{page_prefix}[Error processing page {first_page_num + i + 1}]{page_suffix}"
+                for i in range(len(images))
+            ]
+    
+    @staticmethod
+    async def _run_stage(worker, worker_count: int, next_queue: Optional[asyncio.Queue], next_worker_count: int):
+        """Run the workers of a pipeline stage, then tell each worker of the next stage to stop.
+        If a worker fails or the stage is cancelled, the other workers of the stage are cancelled too."""
+        workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            # Wait for the cancelled workers, so none of them is left running after the stage
+            await asyncio.gather(*workers, return_exceptions=True)
+        if next_queue is not None:
+            for _ in range(next_worker_count):
+                await next_queue.put(None)
+    
     @staticmethod
     async def process_pdf(
-        file: UploadFile,
+        file_path: str,
         page_prefix: str = "\n---\n",
         page_suffix: str = "\n---\n"
     ) -> str:
         try:
-            # Get the file-like object (could be our custom one or a regular file)
-            file_obj = file.file
+            file_size = await aiofiles.os.path.getsize(file_path)
+            logger.debug("Processing PDF with %d bytes", file_size)
             
-            # Get content type if available
-            content_type = getattr(file_obj, 'content_type', 'application/octet-stream')
-            print(f"Processing PDF with content type: {content_type}")
+            if not file_size:
+                raise ValueError("File is empty")
             
-            # Read the file content
-            contents = await file.read()
-            print(f"Read {len(contents)} bytes from file")
+            loop = asyncio.get_running_loop()
             
-            if not contents:
-                raise ValueError("File is empty")
+            page_count = await loop.run_in_executor(render_pool, pdf_page_count, file_path)
+            logger.debug("Processing %d page(s)...", page_count)
             
-            # Convert PDF to images
-            print("Converting PDF to images...")
-            try:
-                # Try with explicit poppler path first
-                poppler_path = "/opt/homebrew/bin"  # Common Homebrew location
-                print(f"Using poppler path: {poppler_path}")
-                
-                # Try with explicit path first
-                try:
-                    images = convert_from_bytes(contents, poppler_path=poppler_path)
-                    print(f"Converted to {len(images)} page(s) using explicit poppler path")
-                except Exception as e:
-                    print(f"First attempt failed with error: {str(e)}")
-                    print("Trying without explicit poppler path...")
-                    # Fall back to system path
-                    images = convert_from_bytes(contents)
-                    print(f"Converted to {len(images)} page(s) using system poppler")
-                    
-            except Exception as e:
-                error_msg = f"Error converting PDF to images: {str(e)}"
-                print(error_msg)
-                # Try to get more detailed error info
-                import subprocess
-                try:
-                    result = subprocess.run(['which', 'pdftoppm'], capture_output=True, text=True)
-                    print(f"pdftoppm path: {result.stdout.strip() if result.stdout else 'Not found'}")
-                    print(f"Error output: {result.stderr}")
-                except Exception as sub_e:
-                    print(f"Could not check pdftoppm: {str(sub_e)}")
-                raise Exception(error_msg) from e
+            # Pages flow through the pipeline in batches of BATCH_SIZE:
+            # render (process pool) -> Gemini (MAX_WORKERS requests),
+            # so the first requests are sent while later pages are still being rendered
+            batches = iter([
+                (first, min(first + BATCH_SIZE - 1, page_count))
+                for first in range(1, page_count + 1, BATCH_SIZE)
+            ])
+            render_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            markdown_pages: Dict[int, str] = {}
             
-            # Process each page concurrently
-            print("Processing pages...")
-            tasks = []
-            for i, image in enumerate(images):
-                task = PDFProcessor._process_page(image, i, page_prefix, page_suffix)
-                tasks.append(asyncio.create_task(task))
+            async def render_worker():
+                # All render workers share the batches iterator, each batch is taken once
+                for first, last in batches:
+                    pages = await loop.run_in_executor(render_pool, render_page_range, file_path, first, last)
+                    await render_queue.put((first - 1, pages))
             
-            # Wait for all pages to be processed
-            markdown_pages = await asyncio.gather(*tasks)
+            async def llm_worker():
+                while (item := await render_queue.get()) is not None:
+                    first_page_num, pages = item
+                    markdown_batch = await PDFProcessor._process_batch(
+                        pages, first_page_num, page_prefix, page_suffix
+                    )
+                    for i, markdown_page in enumerate(markdown_batch):
+                        markdown_pages[first_page_num + i] = markdown_page
             
-            # Combine all pages with separators
-            result = "\n".join(markdown_pages)
-            print(f"Processed {len(markdown_pages)} pages, total {len(result)} characters")
+            stages = [
+                asyncio.create_task(PDFProcessor._run_stage(render_worker, RENDER_WORKERS, render_queue, MAX_WORKERS)),
+                asyncio.create_task(PDFProcessor._run_stage(llm_worker, MAX_WORKERS, None, 0)),
+            ]
+            try:
+                await asyncio.gather(*stages)
+            finally:
+                # Stop the remaining stages if one of them failed and wait until they are done,
+                # the PDF file is removed once process_pdf returns
+                for stage in stages:
+                    stage.cancel()
+                await asyncio.gather(*stages, return_exceptions=True)
+            
+            # Combine all pages in page order with separators
+            result = "\n".join(markdown_pages[page_num] for page_num in range(page_count))
+            logger.debug("Processed %d pages, total %d characters", page_count, len(result))
             return result
             
         except Exception as e:
-            print(f"Error in process_pdf: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error in process_pdf: %s", e)
             raise
 
 @app.post("/api/v1/parsing/upload", response_model=UploadResponse)
@@ -248,17 +489,23 @@ async def upload_pdf(
     page_prefix: Optional[str] = Form("\n---\n"),
     page_suffix: Optional[str] = Form("\n---\n"),
 ):
-    print(f"Received upload request for file: {file.filename}")
+    logger.debug("Received upload request for file: %s", file.filename)
     # Create a new job
-    job_id = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
+    job_id = uuid.uuid4().hex
+    now = now_iso()
     
+    file_path = None
     try:
-        # Read the file content
-        file_content = await file.read()
-        print(f"Read {len(file_content)} bytes from file")
+        # Stream the PDF to disk in chunks, only its path is handed to the background task
+        file_size = 0
+        async with aiofiles.tempfile.NamedTemporaryFile("wb", suffix=".pdf", delete=False) as tmp:
+            file_path = tmp.name
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await tmp.write(chunk)
+                file_size += len(chunk)
+        logger.debug("Read %d bytes from file", file_size)
         
-        if not file_content:
+        if not file_size:
             raise ValueError("Uploaded file is empty")
         
         # Initialize job data
@@ -267,7 +514,6 @@ async def upload_pdf(
             "status": JobStatus.PENDING,
             "created_at": now,
             "updated_at": now,
-            "file_content": file_content,  # Store file content directly
             "file_name": file.filename,
             "content_type": file.content_type,
             "page_prefix": page_prefix,
@@ -277,12 +523,12 @@ async def upload_pdf(
         }
         
         # Store job data
-        jobs[job_id] = job_data
-        print(f"Created job {job_id} for file {file.filename}")
+        await save_job(job_data)
+        logger.debug("Created job %s for file %s", job_id, file.filename)
         
         # Start processing the PDF in the background
-        asyncio.create_task(process_pdf_background(job_id))
-        print(f"Started background processing for job {job_id}")
+        asyncio.create_task(process_pdf_background(job_id, file_path))
+        logger.debug("Started background processing for job %s", job_id)
         
         return UploadResponse(**{
             "id": job_id,
@@ -291,77 +537,44 @@ async def upload_pdf(
             "updated_at": job_data["updated_at"]
         })
     except Exception as e:
-        print(f"Error in upload_pdf: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in upload_pdf: %s", e)
+        if file_path:
+            try:
+                await aiofiles.os.remove(file_path)
+            except FileNotFoundError:
+                pass
         # If there's an error, update the job status
-        if job_id in jobs:
-            jobs[job_id]["status"] = JobStatus.FAILED
-            jobs[job_id]["error"] = str(e)
-            jobs[job_id]["updated_at"] = datetime.utcnow().isoformat()
+        job = await get_job(job_id)
+        if job:
+            job["status"] = JobStatus.FAILED
+            job["error"] = str(e)
+            job["updated_at"] = now_iso()
+            await save_job(job)
         raise HTTPException(
             status_code=500,
             detail=f"Error processing file: {str(e)}"
         )
 
-async def process_pdf_background(job_id: str):
-    print(f"Starting background processing for job {job_id}")
-    if job_id not in jobs:
-        print(f"Job {job_id} not found in jobs")
+async def process_pdf_background(job_id: str, file_path: str):
+    logger.debug("Starting background processing for job %s", job_id)
+    job = await get_job(job_id)
+    if job is None:
+        logger.warning("Job %s not found", job_id)
+        await aiofiles.os.remove(file_path)
         return
     
-    job = jobs[job_id]
     try:
         # Update job status to processing
         job["status"] = JobStatus.PROCESSING
-        job["updated_at"] = datetime.utcnow().isoformat()
-        print(f"Processing job {job_id} - {job['file_name']}")
-        
-        # Create a file-like object from the stored content
-        from fastapi import UploadFile
-        from io import BytesIO
+        job["updated_at"] = now_iso()
+        await save_job(job)
+        logger.debug("Processing job %s - %s", job_id, job['file_name'])
         
         try:
-            file_content = job.get("file_content")
-            if not file_content:
-                raise ValueError("No file content found in job data")
-                
-            print(f"Creating file-like object from {len(file_content)} bytes")
-            file_like = BytesIO(file_content)
-            
-            # Create a custom file-like object with content type
-            class FileLikeWithType:
-                def __init__(self, file_like, content_type):
-                    self.file = file_like
-                    self.content_type = content_type
-                
-                def read(self, *args, **kwargs):
-                    return self.file.read(*args, **kwargs)
-                
-                def seek(self, *args, **kwargs):
-                    return self.file.seek(*args, **kwargs)
-                
-                def tell(self, *args, **kwargs):
-                    return self.file.tell(*args, **kwargs)
-                
-                # Add any other methods that might be needed by UploadFile
-                
-            # Create the file-like object with content type
-            file_with_type = FileLikeWithType(
-                file_like=file_like,
-                content_type=job.get("content_type", "application/octet-stream")
-            )
-            
-            # Create the UploadFile
-            upload_file = UploadFile(
-                filename=job["file_name"],
-                file=file_with_type
-            )
-            
-            print(f"Processing PDF with PDFProcessor")
-            # Process the PDF
+            logger.debug("Processing PDF with PDFProcessor")
+            # Process the PDF, the render workers read it straight from the spooled upload
             markdown_content = await PDFProcessor.process_pdf(
-                upload_file,
+                file_path,
                 job["page_prefix"],
                 job["page_suffix"]
             )
@@ -369,51 +582,46 @@ async def process_pdf_background(job_id: str):
             if not markdown_content or not markdown_content.strip():
                 raise ValueError("PDF processing returned empty content")
                 
-            print(f"Successfully processed PDF, got {len(markdown_content)} characters of markdown")
-            
-            # Clean up the file content to save memory
-            if "file_content" in job:
-                del job["file_content"]
+            logger.debug("Successfully processed PDF, got %d characters of markdown", len(markdown_content))
             
             # Update job with result
             job["status"] = JobStatus.SUCCESS
             job["result"] = {"markdown": markdown_content}
-            job["updated_at"] = datetime.utcnow().isoformat()
-            print(f"Job {job_id} completed successfully")
+            job["updated_at"] = now_iso()
+            await save_job(job)
+            logger.debug("Job %s completed successfully", job_id)
             
         except Exception as e:
-            print(f"Error in PDF processing: {str(e)}")
+            logger.error("Error in PDF processing: %s", e)
             raise
             
     except Exception as e:
         # Update job with error
         error_msg = f"Error processing PDF: {str(e)}"
-        print(error_msg)
+        logger.exception(error_msg)
         job["status"] = JobStatus.FAILED
         job["error"] = error_msg
-        job["updated_at"] = datetime.utcnow().isoformat()
-        
-        # Print traceback for debugging
-        import traceback
-        traceback.print_exc()
+        job["updated_at"] = now_iso()
         
         # Ensure the error is properly set in the job
         if "result" not in job:
             job["result"] = {"error": error_msg}
+        await save_job(job)
+    finally:
+        await aiofiles.os.remove(file_path)
 
 @app.get("/api/v1/parsing/job/{job_id}", response_model=JobResponse)
 async def get_job_status(job_id: str):
-    print(f"\n--- Status request for job {job_id} ---")
-    print(f"Current jobs: {list(jobs.keys())}")
+    logger.debug("Status request for job %s", job_id)
     
-    if job_id not in jobs:
-        print(f"Job {job_id} not found")
+    job = await get_job(job_id)
+    if job is None:
+        logger.debug("Job %s not found", job_id)
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = jobs[job_id]
-    print(f"Job {job_id} status: {job['status']}")
+    logger.debug("Job %s status: %s", job_id, job['status'])
     if job.get('error'):
-        print(f"Job error: {job['error']}")
+        logger.debug("Job error: %s", job['error'])
     
     response_data = {
         "id": job["id"],
@@ -424,26 +632,25 @@ async def get_job_status(job_id: str):
         "error": job.get("error")
     }
     
-    print(f"Returning response: {response_data}")
+    logger.debug("Returning response: %s", response_data)
     return JobResponse(**response_data)
 
-@app.get("/api/v1/parsing/job/{job_id}/result/markdown", response_class=PlainTextResponse)
+@app.get("/api/v1/parsing/job/{job_id}/result/markdown", response_class=StreamingResponse)
 async def get_job_result_markdown(job_id: str):
-    print(f"\n--- Markdown result request for job {job_id} ---")
-    print(f"Current jobs: {list(jobs.keys())}")
+    logger.debug("Markdown result request for job %s", job_id)
     
-    if job_id not in jobs:
-        print(f"Job {job_id} not found")
+    job = await get_job(job_id)
+    if job is None:
+        logger.debug("Job %s not found", job_id)
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = jobs[job_id]
-    print(f"Job {job_id} status: {job['status']}")
+    logger.debug("Job %s status: %s", job_id, job['status'])
     
     if job["status"] != JobStatus.SUCCESS:
         error_msg = f"Job status is {job['status']}. "
         if job.get('error'):
             error_msg += f"Error: {job['error']}"
-        print(error_msg)
+        logger.debug(error_msg)
         raise HTTPException(
             status_code=400,
             detail=error_msg
@@ -451,14 +658,17 @@ async def get_job_result_markdown(job_id: str):
     
     if not job.get("result") or not job["result"].get("markdown"):
         error_msg = "Job completed but no markdown result found"
-        print(error_msg)
+        logger.debug(error_msg)
         raise HTTPException(
             status_code=500,
             detail=error_msg
         )
     
-    print(f"Returning markdown result ({len(job['result']['markdown'])} characters)")
-    return job["result"]["markdown"]
+    logger.debug("Returning markdown result (%d characters)", len(job['result']['markdown']))
+    return StreamingResponse(
+        iter([job["result"]["markdown"].encode()]),
+        media_type="text/markdown"
+    )
 
 if __name__ == "__main__":
     import uvicorn